@@ -1,5 +1,3 @@
-import random
-from collections import defaultdict
 import pickle
 from pathlib import Path
 import numpy as np
@@ -9,6 +7,7 @@ from torchvision.datasets import CIFAR10, CIFAR100
 import torchvision
 import os
 
+
 def get_datasets(data_name, dataroot, normalize=True, val_size=10000):
     """
     get_datasets returns train/val/test data splits of CIFAR10/100 datasets
@@ -32,29 +31,29 @@ def get_datasets(data_name, dataroot, normalize=True, val_size=10000):
     if "cifar" in data_name:
         normalization, data_obj = norm_map[data_name]
 
-        trans = [transforms.ToTensor()]
-
-        if normalize:
-            trans.append(normalization)
-
-        transform = transforms.Compose(trans)
-
         dataset = data_obj(
             dataroot,
             train=True,
-            download=True,
-            transform=transform
+            download=True
         )
 
         test_set = data_obj(
             dataroot,
             train=False,
-            download=True,
-            transform=transform
+            download=True
         )
 
+        # materialize the whole (normalized) data once instead of transforming per sample
+        if not normalize:
+            normalization = None
+        dataset = to_tensor_dataset(dataset, normalization)
+        test_set = to_tensor_dataset(test_set, normalization)
+
         train_size = len(dataset) - val_size
-        train_set, val_set = torch.utils.data.random_split(dataset, [train_size, val_size])
+        perm = torch.randperm(len(dataset)).numpy().astype(np.int32)
+        train_idx, val_idx = perm[:train_size], perm[train_size:]
+        train_set = torch.utils.data.Subset(dataset, train_idx)
+        val_set = torch.utils.data.Subset(dataset, val_idx)
 
     elif data_name == 'cinic10':
         #TODO: To fix the address for normal case
@@ -81,6 +80,36 @@ def get_datasets(data_name, dataroot, normalize=True, val_size=10000):
     return train_set, val_set, test_set
 
 
+def normalize_images(images, mean, std):
+    """
+    converts uint8 images to normalized float32 ones
+    :param images: uint8 tensor of shape (N, C, H, W)
+    :param mean: per channel mean of shape (1, C, 1, 1)
+    :param std: per channel std of shape (1, C, 1, 1)
+    :return: float32 tensor (images / 255 - mean) / std
+    """
+    return images.to(torch.float32).mul_(1 / 255.).sub_(mean).div_(std)
+
+
+def to_tensor_dataset(dataset, normalization=None):
+    """
+    converts a CIFAR datafolder object to an in-memory TensorDataset
+    :param dataset: CIFAR10/100 datafolder object holding uint8 images
+    :param normalization: transforms.Normalize to apply, None to skip
+    :return: TensorDataset of float images in [0, 1] (or normalized) and labels
+    """
+    data = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    if normalization is not None:
+        # (1, C, 1, 1) stats broadcast over the whole (N, C, H, W) tensor
+        mean = torch.tensor(normalization.mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(normalization.std, dtype=torch.float32).view(1, -1, 1, 1)
+        data = normalize_images(data, mean, std)
+    else:
+        data = data.float().div_(255.)
+    targets = torch.tensor(dataset.targets)
+    return torch.utils.data.TensorDataset(data, targets)
+
+
 def get_num_classes_samples(dataset):
     """
     extracts info about certain datafolder
@@ -96,7 +125,9 @@ def get_num_classes_samples(dataset):
         else:
             data_labels_list = dataset.targets
     elif hasattr(dataset, "dataset"):
-        if isinstance(dataset.dataset.targets, list):
+        if not hasattr(dataset.dataset, "targets"):  # subset of tensorDataset Object
+            data_labels_list = np.array(dataset.dataset.tensors[1])[dataset.indices]
+        elif isinstance(dataset.dataset.targets, list):
             data_labels_list = np.array(dataset.dataset.targets)[dataset.indices]
         else:
             data_labels_list = dataset.dataset.targets[dataset.indices]
@@ -107,81 +138,157 @@ def get_num_classes_samples(dataset):
     return num_classes, num_samples, data_labels_list
 
 
-def gen_classes_per_node(dataset, num_users, classes_per_user=2, high_prob=0.6, low_prob=0.4):
+def gen_classes_per_node(num_classes, num_users, classes_per_user=2, high_prob=0.6, low_prob=0.4):
     """
     creates the data distribution of each client
-    :param dataset: pytorch datafolder object
+    :param num_classes: number of classes in the datafolder
     :param num_users: number of clients
     :param classes_per_user: number of classes assigned to each client
     :param high_prob: highest prob sampled
     :param low_prob: lowest prob sampled
-    :return: dictionary mapping between classes and proportions, each entry refers to other client
+    :return: dictionary of (num_users, classes_per_user) arrays of classes and proportions, each row refers to other client
     """
-    num_classes, num_samples, _ = get_num_classes_samples(dataset)
-
     # -------------------------------------------#
     # Divide classes + num samples for each user #
     # -------------------------------------------#
     assert (classes_per_user * num_users) % num_classes == 0, "equal classes appearance is needed"
     count_per_class = (classes_per_user * num_users) // num_classes
-    class_dict = {}
-    for i in range(num_classes):
-        # sampling alpha_i_c
-        probs = np.random.uniform(low_prob, high_prob, size=count_per_class)
-        # normalizing
-        probs_norm = (probs / probs.sum()).tolist()
-        class_dict[i] = {'count': count_per_class, 'prob': probs_norm}
+    # sampling alpha_i_c for all classes at once
+    probs = np.random.uniform(low_prob, high_prob, size=(num_classes, count_per_class))
+    # normalizing
+    probs /= probs.sum(axis=1, keepdims=True)
+    prob_cursor = np.zeros(num_classes, dtype=np.int32)
+    counts = np.full(num_classes, count_per_class, dtype=np.int32)
 
     # -------------------------------------#
     # Assign each client with data indexes #
     # -------------------------------------#
-    class_partitions = defaultdict(list)
-    for i in range(num_users):
-        c = []
-        for _ in range(classes_per_user):
-            class_counts = [class_dict[i]['count'] for i in range(num_classes)]
-            max_class_counts = np.where(np.array(class_counts) == max(class_counts))[0]
+    class_partitions = {
+        'class': np.zeros((num_users, classes_per_user), dtype=np.int32),
+        'prob': np.zeros((num_users, classes_per_user), dtype=np.float64)
+    }
+    picked = np.zeros(num_classes, dtype=bool)
+    for u in range(num_users):
+        picked[:] = False
+        for k in range(classes_per_user):
             # avoid selected classes
-            max_class_counts = list(set(max_class_counts) - set(c))
-            c.append(np.random.choice(max_class_counts))
-            class_dict[c[-1]]['count'] -= 1
-        class_partitions['class'].append(c)
-        class_partitions['prob'].append([class_dict[i]['prob'].pop() for i in c])
+            masked = np.where(picked, -1, counts)
+            max_class_counts = np.flatnonzero(masked == masked.max())
+            pick = np.random.choice(max_class_counts)
+            counts[pick] -= 1
+            picked[pick] = True
+            class_partitions['class'][u, k] = pick
+            class_partitions['prob'][u, k] = probs[pick, prob_cursor[pick]]
+            prob_cursor[pick] += 1
     return class_partitions
 
 
-def gen_data_split(dataset, num_users, class_partitions):
+def bucketize_labels(labels):
+    """
+    groups sample indexes by class using a single sort over the labels
+    :param labels: array of integer labels
+    :return: dictionary mapping class to the indexes of its samples
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable').astype(np.int32, copy=False)
+    boundaries = np.searchsorted(labels[order], np.arange(labels.max() + 2))
+    return {c: order[boundaries[c]:boundaries[c + 1]] for c in range(len(boundaries) - 1)}
+
+
+def gen_data_split(labels_list, num_users, class_partitions, data_class_idx=None, num_samples=None, seed=None):
     """
     divide data indexes for each client based on class_partition
-    :param dataset: pytorch datafolder object (train/val/test)
+    :param labels_list: labels of the split (train/val/test)
     :param num_users: number of clients
     :param class_partitions: proportion of classes per client
+    :param data_class_idx: precomputed class index mapping (see bucketize_labels), computed if None
+    :param num_samples: precomputed number of samples per class, computed if None
+    :param seed: seed for shuffling the class indexes, global numpy random state is used if None
     :return: dictionary mapping client to its indexes
     """
-    num_classes, num_samples, data_labels_list = get_num_classes_samples(dataset)
-
     # -------------------------- #
     # Create class index mapping #
     # -------------------------- #
-    data_class_idx = {i: np.where(data_labels_list == i)[0] for i in range(num_classes)}
+    if data_class_idx is None:
+        data_class_idx = bucketize_labels(labels_list)
+    num_classes = len(data_class_idx)
+    if num_samples is None:
+        num_samples = np.array([len(data_class_idx[c]) for c in range(num_classes)])
 
     # --------- #
     # Shuffling #
     # --------- #
+    rng = np.random if seed is None else np.random.default_rng(seed)
     for data_idx in data_class_idx.values():
-        random.shuffle(data_idx)
+        rng.shuffle(data_idx)
 
     # ------------------------------ #
     # Assigning samples to each user #
     # ------------------------------ #
-    user_data_idx = [[] for i in range(num_users)]
-    for usr_i in range(num_users):
-        for c, p in zip(class_partitions['class'][usr_i], class_partitions['prob'][usr_i]):
-            end_idx = int(num_samples[c] * p)
-            user_data_idx[usr_i].extend(data_class_idx[c][:end_idx])
-            data_class_idx[c] = data_class_idx[c][end_idx:]
+    flat_idx = np.concatenate([data_class_idx[c] for c in range(num_classes)]).astype(np.int32, copy=False)
+    class_offsets = np.zeros(num_classes + 1, dtype=np.int64)
+    class_offsets[1:] = np.cumsum([len(data_class_idx[c]) for c in range(num_classes)])
+    classes = np.asarray(class_partitions['class'])[:num_users]
+    probs = np.asarray(class_partitions['prob'])[:num_users]
+    # number of samples taken from each of the user's classes
+    usr_counts = (np.asarray(num_samples)[classes] * probs).astype(np.int64)
+    dst, row_len = assign_user_samples(flat_idx, class_offsets, classes, usr_counts)
 
-    return user_data_idx
+    return [dst[usr_i, :row_len[usr_i]] for usr_i in range(num_users)]
+
+
+def assign_user_samples(flat_idx, class_offsets, classes, usr_counts):
+    """
+    copies consecutive runs of each class indexes to the users
+    :param flat_idx: class indexes concatenated by class
+    :param class_offsets: start of each class in flat_idx (num_classes + 1 entries)
+    :param classes: (num_users, classes_per_user) classes of each user
+    :param usr_counts: (num_users, classes_per_user) number of samples of each user class
+    :return: padded (num_users, max samples) index matrix, number of samples of each user
+    """
+    num_users, classes_per_user = classes.shape
+    row_len = usr_counts.sum(axis=1)
+    dst = np.empty((num_users, row_len.max()), dtype=np.int32)
+    cursor = np.zeros(len(class_offsets) - 1, dtype=np.int64)
+    for u in range(num_users):
+        out_off = 0
+        for k in range(classes_per_user):
+            c = classes[u, k]
+            n = usr_counts[u, k]
+            start = class_offsets[c] + cursor[c]
+            dst[u, out_off:out_off + n] = flat_idx[start:start + n]
+            cursor[c] += n
+            out_off += n
+    return dst, row_len
+
+
+def gen_user_splits(data_name, data_path, num_users, classes_per_user, normalize=True):
+    """
+    partitions the train/val/test splits between the clients
+    :param data_name: name of datafolder, choose from [cifar10, cifar100]
+    :param data_path: root path for data dir
+    :param num_users: number of clients
+    :param classes_per_user: number of classes assigned to each client
+    :return: list of (base dataset, list of client indexes into it) for train/val/test
+    """
+    splits = []
+    datasets = get_datasets(data_name, data_path, normalize=normalize)
+
+    for i, d in enumerate(datasets):
+        # extract labels once and share them across the split helpers
+        num_classes, num_samples, labels = get_num_classes_samples(d)
+        # ensure same partition for train/test/val
+        if i == 0:
+            cls_partitions = gen_classes_per_node(num_classes, num_users, classes_per_user)
+        usr_subset_idx = gen_data_split(labels, num_users, cls_partitions, bucketize_labels(labels), num_samples)
+        # index the base dataset directly rather than nesting subsets
+        base = d
+        if isinstance(d, torch.utils.data.Subset):
+            base, parent_idx = d.dataset, np.asarray(d.indices, dtype=np.int32)
+            usr_subset_idx = [parent_idx[idx] for idx in usr_subset_idx]
+        splits.append((base, usr_subset_idx))
+
+    return splits
 
 
 def gen_random_loaders(data_name, data_path, num_users, bz, classes_per_user, normalize=True):
@@ -194,20 +301,17 @@ def gen_random_loaders(data_name, data_path, num_users, bz, classes_per_user, no
     :param classes_per_user: number of classes assigned to each client
     :return: train/val/test loaders of each client, list of pytorch dataloaders
     """
-    loader_params = {"batch_size": bz, "shuffle": False, "pin_memory": True, "num_workers": 4}
+    # client shards are small and served from memory, worker processes only add spawn overhead
+    loader_params = {"batch_size": bz, "shuffle": True, "pin_memory": True, "num_workers": 0}
     dataloaders = []
-    datasets = get_datasets(data_name, data_path, normalize=normalize)
 
-    for i, d in enumerate(datasets):
-        # ensure same partition for train/test/val
-        if i == 0:
-            cls_partitions = gen_classes_per_node(d, num_users, classes_per_user)
-            loader_params['shuffle'] = True
-        usr_subset_idx = gen_data_split(d, num_users, cls_partitions)
-        # create subsets for each client
-        subsets = list(map(lambda x: torch.utils.data.Subset(d, x), usr_subset_idx))
-        # create dataloaders from subsets
-        dataloaders.append(list(map(lambda x: torch.utils.data.DataLoader(x, **loader_params), subsets)))
+    for base, usr_subset_idx in gen_user_splits(data_name, data_path, num_users, classes_per_user, normalize):
+        # create dataloaders from the subset of each client
+        dataloaders.append([
+            torch.utils.data.DataLoader(
+                torch.utils.data.Subset(base, idx), **loader_params
+            ) for idx in usr_subset_idx
+        ])
         # do not shuffle at eval and test
         loader_params['shuffle'] = False
 
@@ -219,17 +323,35 @@ def get_dataset_split(pkl_path, split):
         pkl_path = Path(pkl_path)
     data = []
     for i in ("x", "y"):
-        file = pkl_path / "_".join([i, split, "dataset.pkl"])
-        with open(file, "rb") as file:
-            data.append(pickle.load(file))
+        file = pkl_path / "_".join([i, split, "dataset.npy"])
+        if not file.exists():
+            raise FileNotFoundError(f"{file} not found, run convert_pickle_to_npy on {pkl_path} once")
+        # memory map to cut load latency, the conversion below still materializes the split in RAM
+        data.append(np.load(file, mmap_mode="c"))
     x, y = data
-    x = x / 255.0
-    x = torch.from_numpy(x.astype(np.float32)).permute(0, 3, 1, 2)
-    y = torch.from_numpy(y.astype(np.long))
+    # convert uint8 -> float32 directly, skipping a float64 intermediate
+    x = torch.from_numpy(x).permute(0, 3, 1, 2).contiguous().to(torch.float32).mul_(1 / 255.)
+    y = torch.from_numpy(np.asarray(y)).long()
     dataset = torch.utils.data.TensorDataset(x, y)
     return dataset
 
 
+def convert_pickle_to_npy(pkl_path, splits=("train", "valid", "test")):
+    """
+    one-time conversion of the pickled x/y arrays to the .npy files read by get_dataset_split
+    :param pkl_path: dir holding {x,y}_{split}_dataset.pkl files
+    :param splits: names of the splits to convert
+    """
+    if not isinstance(pkl_path, Path):
+        pkl_path = Path(pkl_path)
+    for split in splits:
+        for i in ("x", "y"):
+            file = pkl_path / "_".join([i, split, "dataset.pkl"])
+            with open(file, "rb") as f:
+                arr = pickle.load(f)
+            np.save(file.with_suffix(".npy"), np.asarray(arr))
+
+
 def get_cinic_dataset(pkl_path):
     datasets = []
     for split in ("train", "valid", "test"):